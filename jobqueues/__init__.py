@@ -1,13 +1,34 @@
-from jobqueues.home import home as __home
-import os
 import logging.config
 from jobqueues import _version
 
 __version__ = _version.get_versions()["version"]
 
+_LOGGING_CONFIG = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "simpleFormatter": {
+            "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        }
+    },
+    "handlers": {
+        "consoleHandler": {
+            "class": "logging.StreamHandler",
+            "formatter": "simpleFormatter",
+            "stream": "ext://sys.stderr",
+        }
+    },
+    "loggers": {
+        "jobqueues": {
+            "level": "INFO",
+            "handlers": ["consoleHandler"],
+            "propagate": False,
+        }
+    },
+    "root": {"level": "INFO", "handlers": ["consoleHandler"]},
+}
+
 try:
-    logging.config.fileConfig(
-        os.path.join(__home(), "logging.ini"), disable_existing_loggers=False
-    )
+    logging.config.dictConfig(_LOGGING_CONFIG)
 except Exception:
     print("JobQueues: Logging setup failed")
@@ -1,14 +1,16 @@
 from celery.exceptions import SoftTimeLimitExceeded
 from billiard import current_process
 from jobqueues.util import _getVisibleGPUdevices
+import subprocess
+import psutil
+import time
+import os
 
 
 visibledevs = _getVisibleGPUdevices()
 
 
 def kill(proc_pid):
-    import psutil
-
     process = psutil.Process(proc_pid)
     for proc in process.children(recursive=True):
         proc.kill()
@@ -16,10 +18,6 @@ def kill(proc_pid):
 
 
 def execute_gpu_job(folder, runsh, sentinel, datadir, copyextensions, jobname=None):
-    import subprocess
-    import os
-    import time
-
     worker_index = current_process().index
     gpu_index = worker_index
     if visibledevs is not None:
@@ -52,10 +50,6 @@ def execute_gpu_job(folder, runsh, sentinel, datadir, copyextensions, jobname=No
 
 
 def execute_cpu_job(folder, runsh, sentinel, datadir, copyextensions, jobname=None):
-    import subprocess
-    import os
-    import time
-
     jobsh = os.path.join(folder, "job.sh")
     stdfile = os.path.join(folder, "celery.out")
     _createJobScript(jobsh, folder, runsh, None, sentinel, datadir, copyextensions)
@@ -82,29 +76,31 @@ def execute_cpu_job(folder, runsh, sentinel, datadir, copyextensions, jobname=No
 def _createJobScript(
     fname, workdir, runsh, deviceid, sentinel, datadir, copyextensions
 ):
-    import os
-
-    with open(fname, "w") as f:
-        f.write("#!/bin/bash\n\n")
-        f.write(
-            f'\ntrap "touch {os.path.normpath(os.path.join(workdir, sentinel))}" EXIT SIGTERM SIGINT\n'
-        )
-        f.write("\n")
-        if deviceid is not None:
-            f.write(f"export CUDA_VISIBLE_DEVICES={deviceid}\n\n")
-
-        f.write(f"cd {os.path.abspath(workdir)}\n")
-        f.write(runsh)
-
-        # Move completed trajectories
-        if datadir is not None:
-            datadir = os.path.abspath(datadir)
-            os.makedirs(datadir, exist_ok=True)
-            simname = os.path.basename(os.path.normpath(workdir))
+    workdir = os.path.abspath(workdir)
+    sentinel = os.path.join(workdir, sentinel)
+    parts = [
+        "#!/bin/bash\n\n",
+        f'\ntrap "touch {sentinel}" EXIT SIGTERM SIGINT\n',
+        "\n",
+    ]
+    if deviceid is not None:
+        parts.append(f"export CUDA_VISIBLE_DEVICES={deviceid}\n\n")
+
+    parts.append(f"cd {workdir}\n")
+    parts.append(runsh)
+
+    # Move completed trajectories
+    if datadir is not None:
+        datadir = os.path.abspath(datadir)
+        os.makedirs(datadir, exist_ok=True)
+        simname = os.path.basename(workdir)
+        odir = os.path.join(datadir, simname)
+        if odir != workdir:
             # create directory for new file
-            odir = os.path.join(datadir, simname)
             os.makedirs(odir, exist_ok=True)
-            if os.path.abspath(odir) != os.path.abspath(workdir):
-                f.write("\nmv {} {}".format(" ".join(copyextensions), odir))
+            parts.append("\nmv {} {}".format(" ".join(copyextensions), odir))
+
+    with open(fname, "w") as f:
+        f.write("".join(parts))
 
     os.chmod(fname, 0o700)
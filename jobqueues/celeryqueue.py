@@ -15,6 +15,9 @@ class CeleryQueue(LocalGPUQueue):
     >>> docker run -d -p 5462:5672 rabbitmq
     >>> celery --app=jobqueues.celeryfiles.celery worker --loglevel=info -Q gpu -c 4  -n gpu@%h
     >>> celery --app=jobqueues.celeryfiles.celery worker --loglevel=info -Q cpu -c 10 -n cpu@%h
+
+    The workers and the submitting process share the app created here (``jobqueues.celeryfiles.celery`` exposes
+    it as ``app``). Workers only prefetch one job per process (``worker_prefetch_multiplier = 1``).
     """
 
     def __init__(
@@ -60,6 +63,8 @@ class CeleryQueue(LocalGPUQueue):
                 "jobqueues.celeryfiles.tasks.execute_gpu_job": "gpu",
                 "jobqueues.celeryfiles.tasks.execute_cpu_job": "cpu",
             }
+            # Jobs are long, so don't let a worker reserve jobs while others are idle
+            app.conf.worker_prefetch_multiplier = 1
         except Exception as e:
             raise RuntimeError(f"Could not import Celery app with error: {e}")
 
@@ -4,8 +4,19 @@
 # No redistribution in whole or part
 #
 import os
+import copy
+import json
+import hashlib
+import tempfile
 import logging
 import yaml
+from collections import OrderedDict
+from jobqueues.util import invalidate_binary_cache
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as _YamlLoader
 
 logger = logging.getLogger(__file__)
 
@@ -48,6 +59,79 @@ def config(
     _config["celery"] = celery
     _config["playmolecule"] = playmolecule
     _config["configfile"] = configfile
+    # The new configuration may come with a different environment, so look up the executables again
+    invalidate_binary_cache()
+
+
+# Parsed configuration files by absolute path, with the (mtime, size) they were parsed at
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_MAX = 100
+
+
+def _loadYaml(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+    cached = _YAML_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        _YAML_CACHE.move_to_end(path)
+        return cached[1]
+
+    # Not cached yet or the file was modified since it was parsed
+    configuration = _parseYaml(path)
+    _YAML_CACHE[path] = (key, configuration)
+    _YAML_CACHE.move_to_end(path)
+    if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+        _YAML_CACHE.popitem(last=False)
+    return configuration
+
+
+def _umask():
+    # The umask can only be read by setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def _parseYaml(path):
+    # Parsing JSON is much faster than YAML, so the parsed configuration is stored in a
+    # JSON file next to the YAML file and reused for as long as the YAML content is the same
+    with open(path, "rb") as f:
+        content = f.read()
+    # sha256 since md5 is not available on FIPS-enabled OpenSSL builds
+    version = hashlib.sha256(content).hexdigest()
+    sidecar = path + ".cache.json"
+
+    try:
+        with open(sidecar, "r") as f:
+            cached = json.load(f)
+        if cached.get("content-version") == version:
+            return cached["configuration"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    configuration = yaml.load(content, Loader=_YamlLoader)
+
+    # Only cache configurations which survive the JSON round trip unchanged (e.g. no dates or int keys)
+    try:
+        data = json.dumps({"content-version": version, "configuration": configuration})
+        if json.loads(data)["configuration"] != configuration:
+            return configuration
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            # mkstemp creates the file private to the user, but other users loading a shared
+            # configuration should be able to read the sidecar as they read the YAML file
+            os.fchmod(fd, 0o666 & ~_umask())
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmpfile, sidecar)
+        except OSError:
+            os.remove(tmpfile)
+            raise
+    except (OSError, TypeError, ValueError):
+        # Read-only configuration directories or configurations which are not JSON serializable
+        pass
+    return configuration
 
 
 def loadConfig(cls, queuename, _configfile=None, _configapp=None, _logger=True):
@@ -78,11 +162,12 @@ def loadConfig(cls, queuename, _configfile=None, _configapp=None, _logger=True):
         ):
             logger.warning(f"{_configfile} does not exist or it is not a YAML file.")
 
-        with open(_configfile, "r") as f:
-            configuration = yaml.load(f, Loader=yaml.FullLoader)
-            # Support also config files with all queues in it
-            if queuename in configuration:
-                configuration = configuration[queuename]
+        configuration = _loadYaml(_configfile)
+        # Support also config files with all queues in it
+        if queuename in configuration:
+            configuration = configuration[queuename]
+        # Copy the cached configuration so that the queues can't modify it
+        configuration = copy.deepcopy(configuration)
 
         if _logger:
             logger.info(f"Loaded {queuename} configuration YAML file {_configfile}")
@@ -8,14 +8,39 @@ from jobqueues.util import _getGPUdevices, _filterVisibleGPUdevices
 from protocolinterface import val
 import queue
 import os
+import errno
+import glob
+import shutil
 import threading
-from subprocess import check_output
+import subprocess
+import functools
+import itertools
+import collections
 from abc import abstractmethod
+from math import floor
+import psutil
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# Job states
+_S_QUEUED, _S_RUNNING, _S_COMPLETED = 0, 1, 2
+
+# Queue item which tells a worker thread to exit
+_SHUTDOWN = object()
+
+
+@functools.lru_cache(maxsize=1)
+def _cpu_count():
+    return psutil.cpu_count()
+
+
+@functools.lru_cache(maxsize=1)
+def _total_memory_mib():
+    return psutil.virtual_memory().total >> 20  # Converts bytes to MiB
+
+
 # TODO: Merge CPU and GPU queue into a single one which manages ncpu and ngpu simultaneously
 
 
@@ -60,14 +85,26 @@ class _LocalQueue(SimQueue):
         self._cmdDeprecated("trajext", "copy")
 
         self._states = dict()
+        self._counts = [0, 0, 0]  # Number of jobs in each state
+        self._completed = collections.deque()
+        self._states_lock = threading.Lock()
+        self._abs_datadir = None
         self._queue = None
+        self._threads = []
         self._shutdown = False
+        self._devices_cache = None
+
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        # The selected devices depend on these arguments
+        if key in ("ngpu", "devices", "ncpu", "maxcpu"):
+            self.__dict__["_devices_cache"] = None
 
     def _setupQueue(self):
         if self._queue is None:
-            self._queue = queue.Queue()
+            self._queue = queue.SimpleQueue()
 
-            devices = self._getdevices()
+            devices = self._device_ids()
             self.memory = self._getmemory()
 
             self._threads = []
@@ -79,71 +116,107 @@ class _LocalQueue(SimQueue):
 
     def run_job(self, deviceid):
         queue = self._queue
-        while not self._shutdown:
-            path = None
+        while True:
+            item = queue.get()
+            # Jobs still queued at shutdown are not executed
+            if item is _SHUTDOWN or self._shutdown:
+                break
+
+            path, runsh = item
+            if deviceid is None:
+                logger.info("Running %s", path)
+            else:
+                logger.info("Running %s on device %s", path, deviceid)
+            self._setRunning(path)
+
             try:
-                (path, runsh) = queue.get(timeout=1)
-            except Exception:
-                pass
-
-            if path is not None:
-                if deviceid is None:
-                    logger.info("Running " + path)
-                else:
-                    logger.info("Running " + path + " on device " + str(deviceid))
-                self._setRunning(path)
-
-                jobsh = os.path.join(path, self.jobscript)
-                self._createJobScript(jobsh, path, runsh, deviceid)
-
-                try:
-                    ret = check_output(jobsh)
-                    logger.debug(ret)
-                except Exception as e:
-                    logger.error(f"Error in simulation {path}. {e}")
-                    self._setCompleted(path)
-                    queue.task_done()
-                    continue
-
-                logger.info("Completed " + path)
-                self._setCompleted(path)
-                queue.task_done()
+                self._runJob(path, runsh, deviceid)
+            except subprocess.CalledProcessError as e:
+                stderr = e.stderr.decode(errors="replace")
+                logger.error(f"Error in simulation {path}. {e}\n{stderr}")
+            except Exception as e:
+                logger.error(f"Error in simulation {path}. {e}")
+            else:
+                logger.info("Completed %s", path)
+
+            self._setCompleted(path)
 
         logger.info("Shutting down worker thread")
 
-    def _createJobScript(self, fname, workdir, runsh, gpudevice=None):
-        with open(fname, "w") as f:
-            f.write("#!/bin/bash\n\n")
-            # Trap kill signals to create sentinel file
-            f.write(
-                '\ntrap "touch {}" EXIT SIGTERM\n'.format(
-                    os.path.normpath(os.path.join(workdir, self._sentinel))
-                )
-            )
-            f.write("\n")
-            if gpudevice is not None:
-                f.write(f"export CUDA_VISIBLE_DEVICES={gpudevice}\n\n")
-            f.write(f"cd {os.path.abspath(workdir)}\n")
-            f.write(runsh)
-
-            # Move completed trajectories
-            if self.datadir is not None:
-                datadir = os.path.abspath(self.datadir)
-                os.makedirs(datadir, exist_ok=True)
-                simname = os.path.basename(os.path.normpath(workdir))
-                # create directory for new file
-                odir = os.path.join(datadir, simname)
-                os.makedirs(odir, exist_ok=True)
-                if os.path.abspath(odir) != os.path.abspath(workdir):
-                    f.write("\nmv {} {}".format(" ".join(self.copy), odir))
-
-        os.chmod(fname, 0o700)
+    def _createJobScript(self, workdir, runsh, gpudevice=None):
+        """Returns the (argv, env, cwd) with which to execute a job in-process"""
+        if os.path.isfile(runsh):
+            argv = [runsh]
+        else:
+            # Custom commands are executed as bash code
+            argv = ["/bin/bash", "-c", runsh]
+
+        env = None
+        if gpudevice is not None:
+            env = os.environ.copy()
+            env["CUDA_VISIBLE_DEVICES"] = str(gpudevice)
+
+        return argv, env, workdir
+
+    def _runJob(self, workdir, runsh, gpudevice=None):
+        # workdir is the normalized absolute path queued by submit()
+        argv, env, cwd = self._createJobScript(workdir, runsh, gpudevice)
+        kwargs = dict(
+            cwd=cwd,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            try:
+                subprocess.run(argv, **kwargs)
+            except OSError as e:
+                # Run scripts without a shebang with bash, like a shell would do
+                if e.errno != errno.ENOEXEC:
+                    raise
+                subprocess.run(["/bin/bash"] + argv, **kwargs)
+        finally:
+            try:
+                self._moveCompleted(workdir)
+            finally:
+                # Create the sentinel file also if the job failed or was killed
+                with open(os.path.join(workdir, self._sentinel), "a"):
+                    pass
+
+    def _moveCompleted(self, workdir):
+        # Move completed trajectories
+        if self._abs_datadir is None:
+            return
+
+        simname = os.path.basename(workdir)
+        odir = os.path.join(self._abs_datadir, simname)
+        if odir != workdir:
+            # create directory for new file
+            os.makedirs(odir, exist_ok=True)
+            for pattern in self.copy:
+                for src in glob.glob(os.path.join(workdir, pattern)):
+                    shutil.move(src, os.path.join(odir, os.path.basename(src)))
+
+    def _setState(self, path, state):
+        # Track state counts and completed jobs to avoid scanning all states
+        with self._states_lock:
+            oldstate = self._states.get(path)
+            if oldstate is not None:
+                self._counts[oldstate] -= 1
+            self._states[path] = state
+            self._counts[state] += 1
+            if state == _S_COMPLETED:
+                self._completed.append(path)
+
+    def _setQueued(self, path):
+        self._setState(path, _S_QUEUED)
 
     def _setRunning(self, path):
-        self._states[path] = "R"
+        self._setState(path, _S_RUNNING)
 
     def _setCompleted(self, path):
-        self._states[path] = "C"
+        self._setState(path, _S_COMPLETED)
 
     def retrieve(self):
         """Retrieves a list of jobs that have completed since the last call
@@ -153,11 +226,14 @@ class _LocalQueue(SimQueue):
         >>> comp = app.retrieve()
         """
         ret = []
-        xx = self._states.copy().keys()
-        for i in xx:
-            if self._states[i] == "C":
-                del self._states[i]
-                ret.append(i)
+        with self._states_lock:
+            completed, self._completed = self._completed, collections.deque()
+            for path in completed:
+                # The job might have been resubmitted or already retrieved
+                if self._states.get(path) == _S_COMPLETED:
+                    del self._states[path]
+                    self._counts[_S_COMPLETED] -= 1
+                    ret.append(path)
 
         return ret
 
@@ -179,19 +255,29 @@ class _LocalQueue(SimQueue):
 
         dirs = self._submitinit(dirs)
 
-        for d in dirs:
-            if not os.path.isdir(d):
-                raise NameError("Submit: directory " + d + " does not exist.")
-
-        # if all folders exist, submit
+        # Check all directories and run scripts before queueing any job
+        jobs = []
         for i, d in enumerate(dirs):
             dirname = os.path.abspath(d)
-            logger.info("Queueing " + dirname)
+            if not os.path.isdir(dirname):
+                raise NameError("Submit: directory " + d + " does not exist.")
+            runscript = (
+                commands[i] if commands is not None else self._getRunScript(dirname)
+            )
+            jobs.append((dirname, runscript))
+
+        # Create the data directory once for all jobs
+        self._abs_datadir = None
+        if self.datadir is not None:
+            self._abs_datadir = os.path.abspath(self.datadir)
+            os.makedirs(self._abs_datadir, exist_ok=True)
 
-            runscript = commands[i] if commands is not None else self._getRunScript(d)
-            self._cleanSentinel(d)
+        # if all folders exist, submit
+        for dirname, runscript in jobs:
+            logger.info("Queueing %s", dirname)
+            self._cleanSentinel(dirname)
 
-            self._states[dirname] = "Q"
+            self._setQueued(dirname)
             self._queue.put((dirname, runscript))
 
     def inprogress(self):
@@ -203,23 +289,36 @@ class _LocalQueue(SimQueue):
         -------
         >>> app.inprogress()
         """
-        output_run = sum(x == "R" for x in self._states.values())
-        output_queue = sum(x == "Q" for x in self._states.values())
-
-        return output_run + output_queue
+        return self._counts[_S_RUNNING] + self._counts[_S_QUEUED]
 
     def stop(self):
         self._shutdown = True
+        # Wake up the idle worker threads
+        if self._queue is not None:
+            for _ in self._threads:
+                self._queue.put(_SHUTDOWN)
 
     @abstractmethod
-    def _getdevices(self):
+    def _getdevices(self, _logger=True):
+        """Returns the list of device ids or the number of id-less devices"""
         return list()
 
-    def _getmemory(self):
-        import psutil
+    def _get_cached_devices(self, _logger=True):
+        # Avoid calling nvidia-smi multiple times
+        if self._devices_cache is None:
+            self._devices_cache = self._getdevices(_logger=_logger)
+        return self._devices_cache
+
+    def _device_ids(self):
+        """Returns an iterable with the device id of each worker thread"""
+        return self._get_cached_devices()
+
+    def _ndevices(self):
+        return len(self._get_cached_devices(_logger=False))
 
-        total_memory = int(psutil.virtual_memory().total >> 20)  # Converts bytes to MiB
-        nr_devices = len(self._getdevices(_logger=False))
+    def _getmemory(self):
+        total_memory = _total_memory_mib()
+        nr_devices = self._ndevices()
         if nr_devices != 0:
             return int(total_memory / nr_devices)
         else:
@@ -337,7 +436,7 @@ class LocalGPUQueue(_LocalQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def ncpu(self):
@@ -353,7 +452,7 @@ class LocalGPUQueue(_LocalQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
 
 
 class LocalCPUQueue(_LocalQueue):
@@ -383,8 +482,6 @@ class LocalCPUQueue(_LocalQueue):
     """
 
     def __init__(self):
-        import psutil
-
         super().__init__()
         self._arg(
             "ncpu",
@@ -398,7 +495,7 @@ class LocalCPUQueue(_LocalQueue):
             "int",
             "Number of CPU threads available to this queue. By default, it takes the all the "
             "CPU thread of the machine.",
-            psutil.cpu_count(),
+            _cpu_count(),
             val.Number(int, "POS"),
         )
         self._arg(
@@ -409,32 +506,37 @@ class LocalCPUQueue(_LocalQueue):
             val.Number(int, "0POS"),
         )
 
-    def _getdevices(self):
-        import psutil
-
+    def _getdevices(self, _logger=True):
         if self.ncpu > self.maxcpu:
             raise ValueError(
                 "The ncpu ({}) cannot be greater than the maxcpu ({})".format(
                     self.ncpu, self.maxcpu
                 )
             )
-        if self.maxcpu > psutil.cpu_count():
+        if self.maxcpu > _cpu_count():
             logger.warning(
                 "maxcpu ({}) higher than the total ammount of CPU threads available ({}). "
-                "Overclocking.".format(self.maxcpu, psutil.cpu_count())
+                "Overclocking.".format(self.maxcpu, _cpu_count())
             )
         devices = int(self.maxcpu / self.ncpu)
-        logger.info(
-            'Using {} CPU "devices" ({} / {})'.format(devices, self.maxcpu, self.ncpu)
-        )
-        return [None] * devices
+        if _logger:
+            logger.info(
+                'Using {} CPU "devices" ({} / {})'.format(
+                    devices, self.maxcpu, self.ncpu
+                )
+            )
+        return devices
 
-    def _getmemory(self):
-        from math import floor
-        import psutil
+    def _device_ids(self):
+        # CPU worker threads are not bound to any device
+        return itertools.repeat(None, self._get_cached_devices())
 
-        memory = psutil.virtual_memory().total / 1024 ** 2
-        memory *= max(0, min(1, self.ncpu / psutil.cpu_count()))  # Clamp to [0, 1]
+    def _ndevices(self):
+        return self._get_cached_devices(_logger=False)
+
+    def _getmemory(self):
+        memory = _total_memory_mib()
+        memory *= max(0, min(1, self.ncpu / _cpu_count()))  # Clamp to [0, 1]
         memory = int(floor(memory))
 
         return memory
@@ -445,7 +547,7 @@ class LocalCPUQueue(_LocalQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -461,7 +563,7 @@ class LocalCPUQueue(_LocalQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
 
 
 if __name__ == "__main__":
@@ -4,20 +4,33 @@
 # No redistribution in whole or part
 #
 import os
-import shutil
+import re
+import json
+import time
+import tempfile
 import random
-import string
 from subprocess import check_output, CalledProcessError, DEVNULL
 from protocolinterface import val
 from jobqueues.simqueue import SimQueue
-from jobqueues.util import ensurelist
-from jobqueues.config import loadConfig
+from jobqueues.util import ensurelist, _find_binary, _writeScript
+from jobqueues.config import loadConfig, template_env
 import unittest
 import yaml
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Matches the job ids in the bsub output "Job <1234> is submitted to queue <normal>."
+_JOBID_RE = re.compile(r"Job <(\d+)> is submitted")
+
+
+def _packSize():
+    # Job packs are enabled in LSF by setting LSB_MAX_PACK_JOBS, which is also the maximum pack size
+    try:
+        return int(os.getenv("LSB_MAX_PACK_JOBS", 0))
+    except ValueError:
+        return 0
+
 
 class LsfQueue(SimQueue):
     """Queue system for LSF
@@ -194,92 +207,99 @@ class LsfQueue(SimQueue):
             nargs="*",
         )
 
+        self._joblist = []
+        self._queues_cache = None
+
         # Load LSF configuration profile
         loadConfig(self, "lsf", _configfile, _configapp, _logger)
 
         # Find executables
         if _findExecutables:
-            self._qsubmit = LsfQueue._find_binary("bsub")
-            self._qinfo = LsfQueue._find_binary("bqueues")
-            self._qcancel = LsfQueue._find_binary("bkill")
-            self._qstatus = LsfQueue._find_binary("bjobs")
-
-    @staticmethod
-    def _find_binary(binary):
-        ret = shutil.which(binary, mode=os.X_OK)
-        if not ret:
-            raise FileNotFoundError(
-                "Could not find required executable [{}]".format(binary)
-            )
-        ret = os.path.abspath(ret)
-        return ret
+            self._qsubmit = _find_binary("bsub")
+            self._qinfo = _find_binary("bqueues")
+            self._qcancel = _find_binary("bkill")
+            self._qstatus = _find_binary("bjobs")
 
-    def _createJobScript(self, fname, workdir, runsh):
-        from jobqueues.util import ensurelist
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if key == "queue":
+            self.__dict__["_queues_cache"] = None
 
-        workdir = os.path.abspath(workdir)
-        with open(fname, "w") as f:
-            f.write("#!/bin/bash\n")
-            f.write("#\n")
-            f.write(f"#BSUB -J {self.jobname}\n")
-            f.write('#BSUB -q "{}"\n'.format(" ".join(ensurelist(self.queue))))
-            f.write(f"#BSUB -n {self.ncpu}\n")
-            if self.app is not None:
-                f.write(f"#BSUB -app {self.app}\n")
-            if self.ngpu != 0:
-                if self.version == 9:
-                    if self.gpu_options is not None:
-                        logger.warning(
-                            "gpu_options argument was set while it is not needed for LSF version 9"
-                        )
-                    f.write(
-                        '#BSUB -R "select[ngpus>0] rusage[ngpus_excl_p={}]"\n'.format(
-                            self.ngpu
-                        )
+    @property
+    def _queues(self):
+        """The queue argument as a tuple, cached until the queue is reassigned"""
+        if self._queues_cache is None:
+            self._queues_cache = tuple(ensurelist(self.queue))
+        return self._queues_cache
+
+    def _bsubOptions(self, workdir):
+        """Returns the bsub options of a job, as used in #BSUB lines and job pack files"""
+        options = [
+            f"-J {self.jobname}",
+            '-q "{}"'.format(" ".join(self._queues)),
+            f"-n {self.ncpu}",
+        ]
+        if self.app is not None:
+            options.append(f"-app {self.app}")
+        if self.ngpu != 0:
+            if self.version == 9:
+                if self.gpu_options is not None:
+                    logger.warning(
+                        "gpu_options argument was set while it is not needed for LSF version 9"
                     )
-                elif self.version == 10:
-                    if not self.gpu_options:
-                        self.gpu_options = {"mode": "exclusive_process"}
-                    gpu_requirements = list()
-                    gpu_requirements.append(f"num={self.ngpu}")
-                    for i in self.gpu_options:
-                        gpu_requirements.append(f"{i}={self.gpu_options[i]}")
-                    f.write('#BSUB -gpu "{}"\n'.format(":".join(gpu_requirements)))
-                else:
-                    raise AttributeError("Version not supported")
-            if self.resources is not None:
-                for resource in ensurelist(self.resources):
-                    f.write(f'#BSUB -R "{resource}"\n')
-            f.write(f"#BSUB -M {self.memory}\n")
-            f.write(f"#BSUB -cwd {workdir}\n")
-            f.write(f"#BSUB -outdir {workdir}\n")
-            f.write(f"#BSUB -o {self.outputstream}\n")
-            f.write(f"#BSUB -e {self.errorstream}\n")
-            if self.envvars is not None:
-                f.write(f"#BSUB --env {self.envvars}\n")
-            if self.walltime is not None:
-                f.write(f"#BSUB -W {self.walltime}\n")
-            # Trap kill signals to create sentinel file
-            f.write(
-                '\ntrap "touch {}" EXIT SIGTERM\n'.format(
-                    os.path.normpath(os.path.join(workdir, self._sentinel))
+                options.append(
+                    '-R "select[ngpus>0] rusage[ngpus_excl_p={}]"'.format(self.ngpu)
                 )
+            elif self.version == 10:
+                if not self.gpu_options:
+                    self.gpu_options = {"mode": "exclusive_process"}
+                gpu_requirements = list()
+                gpu_requirements.append(f"num={self.ngpu}")
+                for i in self.gpu_options:
+                    gpu_requirements.append(f"{i}={self.gpu_options[i]}")
+                options.append('-gpu "{}"'.format(":".join(gpu_requirements)))
+            else:
+                raise AttributeError("Version not supported")
+        if self.resources is not None:
+            for resource in ensurelist(self.resources):
+                options.append(f'-R "{resource}"')
+        options.append(f"-M {self.memory}")
+        options.append(f"-cwd {workdir}")
+        options.append(f"-outdir {workdir}")
+        options.append(f"-o {self.outputstream}")
+        options.append(f"-e {self.errorstream}")
+        if self.envvars is not None:
+            options.append(f"--env {self.envvars}")
+        if self.walltime is not None:
+            options.append(f"-W {self.walltime}")
+        return options
+
+    def _createJobScript(self, fname, workdir, runsh, options=None):
+        # abspath already normalizes workdir, so the derived paths need no normpath
+        workdir = os.path.abspath(workdir)
+        sentinel = os.path.join(workdir, self._sentinel)
+        datadir = None
+        if self.datadir is not None:
+            datadir = os.path.abspath(
+                os.path.join(self.datadir, os.path.basename(workdir))
             )
-            f.write("\n")
-            if self.prerun is not None:
-                for call in ensurelist(self.prerun):
-                    f.write(f"{call}\n")
-            f.write(f"\ncd {workdir}\n")
-            f.write(runsh)
-
-            # Move completed trajectories
-            if self.datadir is not None:
-                simname = os.path.basename(os.path.normpath(workdir))
-                datadir = os.path.abspath(os.path.join(self.datadir, simname))
-                os.makedirs(datadir, exist_ok=True)
-                f.write(f"\nmv *.{self.trajext} {datadir}")
-
-        os.chmod(fname, 0o700)
+        if options is None:
+            options = self._bsubOptions(workdir)
+        # Move completed trajectories
+        if datadir is not None:
+            os.makedirs(datadir, exist_ok=True)
+
+        template = template_env.get_template("LSF_job.sh.j2")
+        job_str = template.render(
+            options=options,
+            sentinel=sentinel,
+            prerun=ensurelist(self.prerun) if self.prerun is not None else [],
+            workdir=workdir,
+            runsh=runsh,
+            datadir=datadir,
+            trajext=self.trajext,
+        )
+        _writeScript(fname, job_str)
 
     def retrieve(self):
         # Nothing to do
@@ -287,14 +307,15 @@ class LsfQueue(SimQueue):
 
     def _autoJobName(self, path):
         return (
-            os.path.basename(os.path.abspath(path))
-            + "_"
-            + "".join([random.choice(string.digits) for _ in range(5)])
+            os.path.basename(os.path.abspath(path)) + f"_{random.randrange(100000):05d}"
         )
 
     def submit(self, dirs, commands=None):
         """Submits all directories
 
+        If the LSB_MAX_PACK_JOBS environment variable is set, the jobs are submitted in job packs of that size with
+        a single bsub call per pack.
+
         Parameters
         ----------
         dirs : list
@@ -305,26 +326,54 @@ class LsfQueue(SimQueue):
         if self.queue is None:
             raise ValueError("The queue needs to be defined.")
 
-        # if all folders exist, submit
-        for i, d in enumerate(dirs):
-            logger.info("Queueing " + d)
+        packsize = _packSize()
+        if not packsize:
+            # Job ids are recorded as they come, so that they are kept if a later submission fails
+            self._submitDirs(dirs, commands, self._submitOne, self._joblist.extend)
+            return
 
-            if self.jobname is None:
-                self.jobname = self._autoJobName(d)
+        packlines = self._submitDirs(
+            dirs, commands, lambda d, runscript: self._submitOne(d, runscript, True)
+        )
+        for start in range(0, len(packlines), packsize):
+            self._submitPack(packlines[start : start + packsize])
 
-            runscript = commands[i] if commands is not None else self._getRunScript(d)
-            self._cleanSentinel(d)
+    def _submitOne(self, d, runscript, pack=False):
+        """Creates and submits the job script of a directory
 
-            jobscript = os.path.abspath(os.path.join(d, self.jobscript))
-            self._createJobScript(jobscript, d, runscript)
-            try:
-                ret = check_output(self._qsubmit + " < " + jobscript, shell=True)
-                logger.debug(ret)
-            except CalledProcessError as e:
-                logger.error(e.output)
-                raise
-            except Exception:
-                raise
+        Returns the list of submitted job ids, or the job pack line without submitting if pack is True.
+        """
+        workdir = os.path.abspath(d)
+        jobscript = os.path.join(workdir, self.jobscript)
+        options = self._bsubOptions(workdir)
+        self._createJobScript(jobscript, workdir, runscript, options)
+        if pack:
+            return " ".join(options + [jobscript])
+
+        try:
+            with open(jobscript, "rb") as fh:
+                ret = check_output([self._qsubmit], stdin=fh, text=True)
+            logger.debug(ret)
+        except CalledProcessError as e:
+            logger.error(e.output)
+            raise
+        except Exception:
+            raise
+        return _JOBID_RE.findall(ret)
+
+    def _submitPack(self, packlines):
+        fd, packfile = tempfile.mkstemp(prefix="jobqueues_", suffix=".pack")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(packlines) + "\n")
+            ret = check_output([self._qsubmit, "-pack", packfile], text=True)
+            logger.debug(ret)
+        except CalledProcessError as e:
+            logger.error(e.output)
+            raise
+        finally:
+            os.remove(packfile)
+        self._joblist += _JOBID_RE.findall(ret)
 
     def inprogress(self):
         """Returns the sum of the number of running and queued workunits of the specific group in the engine.
@@ -334,62 +383,64 @@ class LsfQueue(SimQueue):
         total : int
             Total running and queued workunits
         """
-        import time
-        import getpass
-
         if self.queue is None:
             raise ValueError("The queue needs to be defined.")
         if self.jobname is None:
             raise ValueError("The jobname needs to be defined.")
-        user = getpass.getuser()
-        l_total = 0
-        for q in ensurelist(self.queue):
-            cmd = [self._qstatus, "-J", self.jobname, "-u", user, "-q", q]
-            logger.debug(cmd)
 
-            # This command randomly fails so I need to allow it to repeat or it crashes adaptive
-            tries = 0
-            while tries < 3:
-                try:
-                    ret = check_output(cmd, stderr=DEVNULL)
-                except CalledProcessError:
-                    if tries == 2:
-                        raise
-                    tries += 1
-                    time.sleep(3)
-                    continue
-                break
-
-            logger.debug(ret.decode("ascii"))
+        if self.version == 10:
+            # A single JSON query for all queues, filtered here by queue name
+            cmd = [self._qstatus, "-J", self.jobname, "-u", self._user]
+            cmd += ["-o", "stat queue", "-json"]
+            ret = self._runStatus(cmd)
+            records = json.loads(ret).get("RECORDS", [])
+            return sum(1 for r in records if r.get("QUEUE") in self._queues)
+
+        l_total = 0
+        for q in self._queues:
+            cmd = [self._qstatus, "-J", self.jobname, "-u", self._user, "-q", q]
+            ret = self._runStatus(cmd)
 
             # TODO: check lines and handle errors
-            lines = ret.decode("ascii").split("\n")
-            lines = len(lines) - 2
-            if lines < 0:
-                lines = 0  # something odd happened
-            l_total += lines
+            # One line per job after the header, counted without splitting the output
+            l_total += max(0, ret.count("\n") - 1)
         return l_total
 
+    def _runStatus(self, cmd, maxtries=3):
+        logger.debug(cmd)
+
+        # This command randomly fails so I need to allow it to repeat or it crashes adaptive
+        tries = 0
+        while True:
+            try:
+                ret = check_output(cmd, stderr=DEVNULL, text=True)
+            except CalledProcessError:
+                if tries == maxtries - 1:
+                    raise
+                time.sleep(0.5 * 2**tries)
+                tries += 1
+                continue
+            break
+
+        logger.debug(ret)
+        return ret
+
     def stop(self):
         """Cancels all currently running and queued jobs"""
-        import getpass
-
         if self.jobname is None:
             raise ValueError("The jobname needs to be defined.")
 
-        user = getpass.getuser()
-
         if self.queue is not None:
-            for q in ensurelist(self.queue):
-                cmd = [self._qcancel, "-J", self.jobname, "-u", user, "-q", q]
+            for q in self._queues:
+                cmd = [self._qcancel, "-J", self.jobname, "-u", self._user, "-q", q]
                 logger.debug(cmd)
-                ret = check_output(cmd, stderr=DEVNULL)
-                logger.debug(ret.decode("ascii"))
+                ret = check_output(cmd, stderr=DEVNULL, text=True)
+                logger.debug(ret)
         else:
-            cmd = [self._qcancel, "-J", self.jobname, "-u", user]
+            cmd = [self._qcancel, "-J", self.jobname, "-u", self._user]
             logger.debug(cmd)
-            ret = check_output(cmd, stderr=DEVNULL)
-            logger.debug(ret.decode("ascii"))
+            ret = check_output(cmd, stderr=DEVNULL, text=True)
+            logger.debug(ret)
 
     @property
     def ncpu(self):
@@ -397,7 +448,7 @@ class LsfQueue(SimQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -405,7 +456,7 @@ class LsfQueue(SimQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def memory(self):
@@ -413,7 +464,7 @@ class LsfQueue(SimQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
 
 
 class _TestLsfQueue(unittest.TestCase):
@@ -4,17 +4,19 @@
 # No redistribution in whole or part
 #
 import os
-import shutil
 import random
-import string
 from subprocess import check_output, CalledProcessError
 from protocolinterface import val
 from jobqueues.simqueue import SimQueue
+from jobqueues.util import _find_binary, _writeScript
 from jobqueues.config import loadConfig
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of job ids passed to a single qdel call
+_QDEL_CHUNK = 500
+
 
 class PBSQueue(SimQueue):
     """
@@ -116,100 +118,100 @@ class PBSQueue(SimQueue):
         self._arg(
             "scratch_local", "int", "Local scratch in MB", None, val.Number(int, "0POS")
         )
+        self._envvars_cache = None
+        self._walltime_cache = None
 
         loadConfig(self, "pbs", _configfile, _configapp, _logger)
 
         # Find executables
         if _findExecutables:
-            self._qsubmit = PBSQueue._find_binary("qsub")
-            self._qinfo = PBSQueue._find_binary("qstat") + " -a"
-            self._qcancel = PBSQueue._find_binary("qdel")
-            self._qstatus = PBSQueue._find_binary("qstat") + " -Q"
+            self._qsubmit = _find_binary("qsub")
+            self._qinfo = _find_binary("qstat") + " -a"
+            self._qcancel = _find_binary("qdel")
+            self._qstatus = _find_binary("qstat") + " -Q"
 
         self._sentinel = "jobqueues.done"
         # For synchronous
         self._joblist = []
-        self._dirs = []
-
-    @staticmethod
-    def _find_binary(binary):
-        ret = shutil.which(binary, mode=os.X_OK)
-        if not ret:
-            raise FileNotFoundError(
-                "Could not find required executable [{}]".format(binary)
+        self._dirs = {}
+
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if key == "environment":
+            self.__dict__["_envvars_cache"] = None
+        elif key == "walltime":
+            self.__dict__["_walltime_cache"] = None
+
+    @property
+    def _envvars(self):
+        """The set environment variables to propagate, cached until environment is reassigned"""
+        if self._envvars_cache is None:
+            self._envvars_cache = ",".join(
+                i for i in self.environment.split(",") if os.environ.get(i)
             )
-        ret = os.path.abspath(ret)
-        return ret
+        return self._envvars_cache
+
+    @property
+    def _walltime(self):
+        """The walltime formatted as H:MM:SS, cached until walltime is reassigned"""
+        if self._walltime_cache is None:
+            minutes, seconds = divmod(self.walltime, 60)
+            hours, minutes = divmod(minutes, 60)
+            self._walltime_cache = f"{hours}:{minutes:02d}:{seconds:02d}"
+        return self._walltime_cache
 
     def _createJobScript(self, fname, workdir, runsh):
+        # abspath already normalizes workdir, so the derived paths need no normpath
         workdir = os.path.abspath(workdir)
+        sentinel = os.path.join(workdir, self._sentinel)
+        datadir = None
+        if self.datadir is not None:
+            datadir = os.path.abspath(
+                os.path.join(self.datadir, os.path.basename(workdir))
+            )
         if not self.queue and self.ngpu > 0:
             self.queue = "gpgpu"
-        with open(fname, "w") as f:
-            f.write("#!/bin/bash\n")
-            f.write("#\n")
-            if self.jobname:
-                f.write(f"#PBS -N={self.jobname}\n")
-            f.write(
-                f"#PBS -lselect=1:ncpus={self.ncpu}:ngpus={self.ngpu}:mem={self.memory}MB"
-            )
-            if self.scratch_local is not None:
-                f.write(f":scratch_local={self.scratch_local}MB")
-            if self.cluster is not None:
-                f.write(f":cl_{self.cluster}=True")
-            f.write("\n")
-            if self.queue:
-                f.write(f"#PBS -q  {self.queue}\n")
-            hours = int(self.walltime / 3600)
-            minutes = int((self.walltime % 3600) / 60)
-            seconds = self.walltime % 3600 % 60
-            f.write(f"#PBS -lwalltime={hours}:{minutes}:{seconds}\n")
-            if self.environment is not None:
-                a = []
-                for i in self.environment.split(","):
-                    if (i in os.environ) and len(os.environ[i]):
-                        a.append(i)
-                f.write("#PBS -v %s\n" % (",".join(a)))
-            # Trap kill signals to create sentinel file
-            f.write(
-                '\ntrap "touch {}" EXIT SIGTERM\n'.format(
-                    os.path.normpath(os.path.join(workdir, self._sentinel))
-                )
-            )
-            f.write(f"\ncd {workdir}\n")
-            f.write(runsh)
-
-            # Move completed trajectories
-            if self.datadir is not None:
-                simname = os.path.basename(os.path.normpath(workdir))
-                datadir = os.path.abspath(os.path.join(self.datadir, simname))
-                os.makedirs(datadir, exist_ok=True)
-                f.write(f"\nmv *.{self.trajext} {datadir}")
-
-        os.chmod(fname, 0o700)
+        parts = ["#!/bin/bash\n", "#\n"]
+        if self.jobname:
+            parts.append(f"#PBS -N={self.jobname}\n")
+        parts.append(
+            f"#PBS -lselect=1:ncpus={self.ncpu}:ngpus={self.ngpu}:mem={self.memory}MB"
+        )
+        if self.scratch_local is not None:
+            parts.append(f":scratch_local={self.scratch_local}MB")
+        if self.cluster is not None:
+            parts.append(f":cl_{self.cluster}=True")
+        parts.append("\n")
+        if self.queue:
+            parts.append(f"#PBS -q  {self.queue}\n")
+        parts.append(f"#PBS -lwalltime={self._walltime}\n")
+        if self.environment is not None and self._envvars:
+            parts.append(f"#PBS -v {self._envvars}\n")
+        # Trap kill signals to create sentinel file
+        parts.append(f'\ntrap "touch {sentinel}" EXIT SIGTERM\n')
+        parts.append(f"\ncd {workdir}\n")
+        parts.append(runsh)
+
+        # Move completed trajectories
+        if datadir is not None:
+            os.makedirs(datadir, exist_ok=True)
+            parts.append(f"\nmv *.{self.trajext} {datadir}")
+
+        _writeScript(fname, "".join(parts))
 
     def retrieve(self):
         # Nothing to do
         pass
 
     def _autoQueueName(self):
-        ret = check_output(self._qinfo)
+        ret = check_output(self._qinfo, text=True)
         return ",".join(
-            list(
-                set(
-                    [
-                        i.split()[0].strip("*")
-                        for i in ret.decode("ascii").split("\n")[1:-1]
-                    ]
-                )
-            )
+            list(set([i.split()[0].strip("*") for i in ret.split("\n")[1:-1]]))
         )
 
     def _autoJobName(self, path):
         return (
-            os.path.basename(os.path.abspath(path))
-            + "_"
-            + "".join([random.choice(string.digits) for _ in range(5)])
+            os.path.basename(os.path.abspath(path)) + f"_{random.randrange(100000):05d}"
         )
 
     def submit(self, dirs, commands=None):
@@ -225,32 +227,31 @@ class PBSQueue(SimQueue):
         if self.queue is None:
             self.queue = self._autoQueueName()
 
-        # if all folders exist, submit
-        for i, d in enumerate(dirs):
-            logger.info("Queueing " + d)
-
-            if self.jobname is None:
-                self.jobname = self._autoJobName(d)
+        def _record(jid):
+            if jid is not None:
+                self._joblist.append(jid)
 
-            runscript = commands[i] if commands is not None else self._getRunScript(d)
-            self._cleanSentinel(d)
+        self._submitDirs(dirs, commands, self._submitOne, _record)
 
-            jobscript = os.path.abspath(os.path.join(d, self.jobscript))
-            self._createJobScript(jobscript, d, runscript)
+    def _submitOne(self, d, runscript):
+        """Creates and submits the job script of a directory and returns its job id"""
+        jobscript = os.path.abspath(os.path.join(d, self.jobscript))
+        self._createJobScript(jobscript, d, runscript)
+        jid = None
+        try:
+            ret = check_output([self._qsubmit, jobscript], text=True)
             try:
-                ret = check_output([self._qsubmit, jobscript])
-                try:
-                    jid = ret.decode("ascii").split("\n")[0]
-                    self._joblist.append(jid)
-                    logger.info("Job id %s" % jid)
-                except Exception:
-                    pass
-                logger.debug(ret)
-            except CalledProcessError as e:
-                logger.error(e.output)
-                raise
+                jid = ret.split("\n")[0]
+                logger.info("Job id %s" % jid)
             except Exception:
-                raise
+                pass
+            logger.debug(ret)
+        except CalledProcessError as e:
+            logger.error(e.output)
+            raise
+        except Exception:
+            raise
+        return jid
 
     def inprogress(self, debug=False):
         """Returns the sum of the number of running and queued workunits of the specific group in the engine.
@@ -261,21 +262,19 @@ class PBSQueue(SimQueue):
             Total running and queued workunits
         """
         import time
-        import getpass
 
         if self.queue is None:
             self.queue = self._autoQueueName()
         if self.jobname is None:
             raise ValueError("The jobname needs to be defined.")
-        user = getpass.getuser()
-        cmd = [self._qstatus, "-J", self.jobname, "-u", user, "-q", self.queue]
+        cmd = [self._qstatus, "-J", self.jobname, "-u", self._user, "-q", self.queue]
         logger.debug(cmd)
 
         # This command randomly fails so I need to allow it to repeat or it crashes adaptive
         tries = 0
         while tries < 3:
             try:
-                ret = check_output(cmd)
+                ret = check_output(cmd, text=True)
             except CalledProcessError:
                 if tries == 2:
                     raise
@@ -284,25 +283,23 @@ class PBSQueue(SimQueue):
                 continue
             break
 
-        logger.debug(ret.decode("ascii"))
+        logger.debug(ret)
 
         # TODO: check lines and handle errors
-        lines = ret.decode("ascii").split("\n")
-        lines = len(lines) - 2
-        if lines < 0:
-            lines = 0  # something odd happened
-        return lines
+        # One line per job after the header, counted without splitting the output
+        return max(0, ret.count("\n") - 1)
 
     def stop(self):
         """Cancels all currently running and queued jobs"""
 
-        if self.partition is None:
-            raise ValueError("The partition needs to be defined.")
-        for j in self._joblist:
-            cmd = [self._qcancel, j]
+        if not self._joblist:
+            return
+        # qdel accepts multiple job ids, chunked to keep the command line short
+        for start in range(0, len(self._joblist), _QDEL_CHUNK):
+            cmd = [self._qcancel] + self._joblist[start : start + _QDEL_CHUNK]
             logger.debug(cmd)
-            ret = check_output(cmd)
-            logger.debug(ret.decode("ascii"))
+            ret = check_output(cmd, text=True)
+            logger.debug(ret)
 
     @property
     def ncpu(self):
@@ -310,7 +307,7 @@ class PBSQueue(SimQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -318,7 +315,7 @@ class PBSQueue(SimQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def memory(self):
@@ -326,7 +323,7 @@ class PBSQueue(SimQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
 
 
 if __name__ == "__main__":
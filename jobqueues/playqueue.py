@@ -191,7 +191,7 @@ class PlayQueue(SimQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -199,7 +199,7 @@ class PlayQueue(SimQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def memory(self):
@@ -207,4 +207,4 @@ class PlayQueue(SimQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
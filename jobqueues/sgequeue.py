@@ -4,19 +4,50 @@
 # No redistribution in whole or part
 #
 import os
-import shutil
+import time
 import random
-import string
+import xml.etree.ElementTree as ET
 from subprocess import check_output, CalledProcessError, DEVNULL
 from protocolinterface import val
 from jobqueues.simqueue import SimQueue
-from jobqueues.util import ensurelist
-from jobqueues.config import loadConfig
+from jobqueues.util import ensurelist, _find_binary, _writeScript
+from jobqueues.config import loadConfig, template_env
 from math import ceil
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of job ids passed to a single qdel call
+_QDEL_CHUNK = 500
+
+# Queue options used in the #$ lines of the job scripts
+_HEADER_ATTRS = (
+    "jobname",
+    "queue",
+    "pe",
+    "ncpu",
+    "ngpu",
+    "memory",
+    "envvars",
+    "walltime",
+)
+
+
+def _taskCount(job):
+    # Pending tasks of an array job are listed as a single job with a task range like "2-10:1"
+    tasks = job.find("tasks")
+    if tasks is None or not tasks.text:
+        return 1
+    count = 0
+    for taskrange in tasks.text.split(","):
+        first, _, rest = taskrange.partition("-")
+        if not rest:
+            count += 1
+            continue
+        last, _, step = rest.partition(":")
+        count += len(range(int(first), int(last) + 1, int(step or 1)))
+    return count
+
 
 class SgeQueue(SimQueue):
     """Queue system for Sun Grid Engine
@@ -48,6 +79,10 @@ class SgeQueue(SimQueue):
         "prerun": [],
     }
 
+    # Time of the last successful qstat check of each qstat executable
+    _qstatOK = {}
+    _qstatTTL = 60
+
     def __init__(
         self, _configapp=None, _configfile=None, _findExecutables=True, _logger=True
     ):
@@ -151,19 +186,26 @@ class SgeQueue(SimQueue):
             nargs="*",
         )
 
+        self._header_cache = None
+        self._templates = {}
+
         # Load SGE configuration profile
         loadConfig(self, "sge", _configfile, _configapp, _logger)
 
         # Find executables
         if _findExecutables:
-            self._qsubmit = SgeQueue._find_binary("qsub")
-            self._qinfo = SgeQueue._find_binary("qhost")
-            self._qcancel = SgeQueue._find_binary("qdel")
-            self._qstatus = SgeQueue._find_binary("qstat")
+            self._qsubmit = _find_binary("qsub")
+            self._qinfo = _find_binary("qhost")
+            self._qcancel = _find_binary("qdel")
+            self._qstatus = _find_binary("qstat")
             self._checkQueue()
 
     def _checkQueue(self):
-        # Check if the slurm daemon is running by executing squeue
+        # Check if the SGE daemon is running by executing qstat. A successful check is
+        # trusted for _qstatTTL seconds so that creating many queues does not run qstat each time
+        lastcheck = SgeQueue._qstatOK.get(self._qstatus)
+        if lastcheck is not None and time.monotonic() - lastcheck < SgeQueue._qstatTTL:
+            return
         try:
             _ = check_output([self._qstatus])
         except CalledProcessError as e:
@@ -172,20 +214,39 @@ class SgeQueue(SimQueue):
             )
         except Exception as e:
             raise RuntimeError(f"SGE qstat command failed with error: {e}")
+        SgeQueue._qstatOK[self._qstatus] = time.monotonic()
+
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if key in _HEADER_ATTRS:
+            self.__dict__["_header_cache"] = None
 
-    @staticmethod
-    def _find_binary(binary):
-        ret = shutil.which(binary, mode=os.X_OK)
-        if not ret:
-            raise FileNotFoundError(
-                "Could not find required executable [{}]".format(binary)
+    def _headerArgs(self):
+        """Template arguments of the #$ job options shared by single and array jobs
+
+        They only depend on the queue options, so they are cached until one of them is reassigned.
+        """
+        if self._header_cache is None:
+            memory = int(ceil(self.memory / 1000)) if self.memory is not None else None
+            self._header_cache = dict(
+                jobname=self.jobname,
+                queue=",".join(ensurelist(self.queue)),
+                pe=self.pe,
+                cores=self.ncpu,
+                ngpu=self.ngpu,
+                memory=memory,
+                envvars=self.envvars,
+                walltime=self.walltime,
             )
-        ret = os.path.abspath(ret)
-        return ret
+        return self._header_cache
 
-    def _createJobScript(self, fname, workdir, runsh):
-        from jobqueues.config import template_env
+    def _getTemplate(self, name):
+        # Looking a template up in the environment checks the template file for changes
+        if name not in self._templates:
+            self._templates[name] = template_env.get_template(name)
+        return self._templates[name]
 
+    def _createJobScript(self, fname, workdir, runsh):
         workdir = os.path.abspath(workdir)
         sentinel = os.path.normpath(os.path.join(workdir, self._sentinel))
         # Move completed trajectories
@@ -199,19 +260,10 @@ class SgeQueue(SimQueue):
             odir = os.path.join(datadir, simname)
             os.makedirs(odir, exist_ok=True)
 
-        memory = int(ceil(self.memory / 1000)) if self.memory is not None else None
-
-        template = template_env.get_template("SGE_job.sh.j2")
+        template = self._getTemplate("SGE_job.sh.j2")
         job_str = template.render(
-            jobname=self.jobname,
-            queue=",".join(ensurelist(self.queue)),
-            pe=self.pe,
-            cores=self.ncpu,
-            ngpu=self.ngpu,
-            memory=memory,
+            **self._headerArgs(),
             workdir=workdir,
-            envvars=self.envvars,
-            walltime=self.walltime,
             sentinel=sentinel,
             prerun=self.prerun,
             runsh=runsh,
@@ -220,10 +272,7 @@ class SgeQueue(SimQueue):
             trajext=self.trajext,
         )
 
-        with open(fname, "w") as f:
-            f.write(job_str)
-
-        os.chmod(fname, 0o700)
+        _writeScript(fname, job_str)
 
     def retrieve(self):
         # Nothing to do
@@ -231,55 +280,86 @@ class SgeQueue(SimQueue):
 
     def _autoJobName(self, path):
         return (
-            os.path.basename(os.path.abspath(path))
-            + "_"
-            + "".join([random.choice(string.digits) for _ in range(5)])
+            os.path.basename(os.path.abspath(path)) + f"_{random.randrange(100000):05d}"
         )
 
-    def submit(self, dirs, commands=None):
+    def submit(self, dirs, commands=None, batch=False):
         """Submits all directories
 
         Parameters
         ----------
         dirs : list
             A list of executable directories.
+        batch : bool
+            If True, all directories are submitted with a single qsub call as the tasks of an SGE array job.
+            The array job runs in the first directory, while the output of every task is still written to
+            the PM<jobname>.o<jobid> and PM<jobname>.e<jobid> files of its own directory.
         """
         dirs = self._submitinit(dirs)
 
         if self.queue is None:
             raise ValueError("The queue needs to be defined.")
 
-        # if all folders exist, submit
-        for i, d in enumerate(dirs):
-            logger.info("Queueing " + d)
+        if batch:
+            self._submitArray(dirs, commands)
+            return
+
+        self._submitDirs(dirs, commands, self._submitOne)
+
+    def _submitOne(self, d, runscript):
+        """Creates and submits the job script of a directory"""
+        jobscript = os.path.abspath(os.path.join(d, self.jobscript))
+        self._createJobScript(jobscript, d, runscript)
+        try:
+            with open(jobscript, "rb") as fh:
+                ret = check_output([self._qsubmit], stdin=fh)
+            logger.debug(ret)
+        except CalledProcessError as e:
+            logger.error(e.output)
+            raise
+        except Exception:
+            raise
+
+    def _submitArray(self, dirs, commands=None):
+        if len(dirs) == 0:
+            return
+        if self.jobname is None:
+            self.jobname = self._autoJobName(dirs[0])
 
-            if self.jobname is None:
-                self.jobname = self._autoJobName(d)
+        # Every task of the array job executes the job script of its directory
+        jobscripts = []
+        for i, d in enumerate(dirs):
+            logger.info("Queueing %s", d)
 
             runscript = commands[i] if commands is not None else self._getRunScript(d)
             self._cleanSentinel(d)
 
             jobscript = os.path.abspath(os.path.join(d, self.jobscript))
             self._createJobScript(jobscript, d, runscript)
-            try:
-                ret = check_output(self._qsubmit + " < " + jobscript, shell=True)
-                logger.debug(ret)
-            except CalledProcessError as e:
-                logger.error(e.output)
-                raise
-            except Exception:
-                raise
+            jobscripts.append(jobscript)
 
-    def _getJobStatusTree(self):
-        import xml.etree.ElementTree as ET
-        import getpass
-        import time
+        workdir = os.path.dirname(jobscripts[0])
+        arrayscript = os.path.join(workdir, "array_" + self.jobscript)
+        template = self._getTemplate("SGE_array_job.sh.j2")
+        job_str = template.render(
+            **self._headerArgs(), workdir=workdir, jobscripts=jobscripts
+        )
+        _writeScript(arrayscript, job_str)
+
+        try:
+            ret = check_output(
+                [self._qsubmit, "-t", f"1-{len(jobscripts)}", arrayscript]
+            )
+            logger.debug(ret)
+        except CalledProcessError as e:
+            logger.error(e.output)
+            raise
 
+    def _getJobStatusTree(self):
         if self.jobname is None:
             raise ValueError("The jobname needs to be defined.")
 
-        user = getpass.getuser()
-        cmd = [self._qstatus, "-u", user, "-xml"]
+        cmd = [self._qstatus, "-u", self._user, "-xml"]
         if self.queue is not None:
             cmd += ["-q", ",".join(ensurelist(self.queue))]
 
@@ -298,8 +378,9 @@ class SgeQueue(SimQueue):
                 continue
             break
 
-        logger.debug(ret.decode("ascii"))
-        return ET.fromstring(ret.decode("ascii").strip())
+        ret = ret.decode("ascii")
+        logger.debug(ret)
+        return ET.fromstring(ret.strip())
 
     def inprogress(self):
         """Returns the sum of the number of running and queued workunits of the specific group in the engine.
@@ -317,7 +398,7 @@ class SgeQueue(SimQueue):
         count = 0
         for job in jobs:
             if job.find("JB_name").text == "PM" + self.jobname:
-                count += 1
+                count += _taskCount(job)
         return count
 
     def stop(self):
@@ -327,12 +408,22 @@ class SgeQueue(SimQueue):
         if len(jobs) == 0:
             return
 
-        for job in jobs:
-            if job.find("JB_name").text == "PM" + self.jobname:
-                jobid = job.find("JB_job_number").text
-                cmd = [self._qcancel, jobid]
-                logger.debug(cmd)
-                ret = check_output(cmd, stderr=DEVNULL)
+        # Running array tasks are listed separately but share the job id of their array job
+        jobname = "PM" + self.jobname
+        jobids = list(
+            dict.fromkeys(
+                job.find("JB_job_number").text
+                for job in jobs
+                if job.find("JB_name").text == jobname
+            )
+        )
+
+        # qdel accepts multiple job ids, chunked to keep the command line short
+        for start in range(0, len(jobids), _QDEL_CHUNK):
+            cmd = [self._qcancel] + jobids[start : start + _QDEL_CHUNK]
+            logger.debug(cmd)
+            ret = check_output(cmd, stderr=DEVNULL)
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(ret.decode("ascii"))
 
     @property
@@ -341,7 +432,7 @@ class SgeQueue(SimQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -349,7 +440,7 @@ class SgeQueue(SimQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def memory(self):
@@ -357,7 +448,7 @@ class SgeQueue(SimQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
 
 
 # # Had to disable testing because pytest 6.0.0rc1 is incompatible with jinja 2.11.2. If they ever fix this issue enable again
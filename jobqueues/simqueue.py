@@ -5,13 +5,50 @@
 #
 from abc import ABC, abstractmethod
 from protocolinterface import ProtocolInterface, val
-from jobqueues.util import ensurelist
+from jobqueues.util import ensurelist, _threadMap, _SentinelWatcher
 import logging
+import functools
+import getpass
 import enum
+import os
+import sys
+import time
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
+def _currentUser():
+    # Look up the effective user directly instead of going through the environment
+    # variables checked first by getpass.getuser. The user does not change during the
+    # lifetime of the process, so it is resolved once, on first use
+    try:
+        import pwd
+
+        return pwd.getpwuid(os.geteuid()).pw_name
+    except (ImportError, KeyError):
+        pass
+    try:
+        return getpass.getuser()
+    except (ImportError, KeyError, OSError):
+        # Containers run with an arbitrary uid have no passwd entry nor USER variable
+        uid = str(os.geteuid())
+        logger.warning(f"Could not determine the user name, using the user id {uid}")
+        return uid
+
+
+def _submitFanout():
+    # Maximum number of concurrent job submissions, configurable for schedulers with a limited ingest rate
+    try:
+        return max(1, int(os.getenv("JOBQUEUES_SUBMIT_FANOUT", 32)))
+    except ValueError:
+        return 32
+
+
+# Number of pending directories above which notcompleted checks the sentinels in a thread pool
+_PARALLEL_STAT_THRESHOLD = 256
+
+
 @enum.unique
 class QueueJobStatus(enum.IntEnum):
     """Job status codes"""
@@ -80,7 +117,8 @@ class SimQueue(ABC, ProtocolInterface):
         super().__init__()
         ProtocolInterface.__init__(self)
         self._sentinel = "jobqueues.done"
-        # For synchronous
+        # For synchronous. Submitted directories which have not completed yet, in submission
+        # order (dict keys with None values), so that notcompleted only checks the pending ones
         self._dirs = None
         self._arg(
             "runscript",
@@ -97,6 +135,11 @@ class SimQueue(ABC, ProtocolInterface):
             val.String(),
         )
 
+    @property
+    def _user(self):
+        """The user running the jobs, resolved on first use since only the batch queues need it"""
+        return _currentUser()
+
     @abstractmethod
     def retrieve(self):
         """Subclasses need to implement this method"""
@@ -110,16 +153,65 @@ class SimQueue(ABC, ProtocolInterface):
     def _submitinit(self, dirs):
         dirs = ensurelist(dirs)
         if self._dirs is None:
-            self._dirs = []
-        self._dirs += dirs
+            self._dirs = {}
+        # Keyed by absolute path, so that a directory is tracked once however it is passed
+        self._dirs.update(dict.fromkeys(os.path.abspath(d) for d in dirs))
         return dirs
 
+    def _submitDirs(self, dirs, commands, submitfunc, onresult=None):
+        """Prepares every directory for submission and passes it to a submit function
+
+        The directories are processed concurrently in a thread pool, since each submission
+        usually blocks on the scheduler acknowledging the job. The number of concurrent
+        submissions defaults to 32 and can be set with the JOBQUEUES_SUBMIT_FANOUT environment variable.
+
+        Parameters
+        ----------
+        dirs : list
+            A list of executable directories.
+        commands : list
+            A list of commands to run in each directory instead of their run scripts. Can be None.
+        submitfunc : callable
+            Function called as submitfunc(dir, runscript) which creates and submits the job of a directory
+        onresult : callable
+            If not None, it is called in order with the return value of every successful submitfunc call.
+            If a submission fails, the ones which have not started are cancelled and the error is raised
+            after onresult has received the results of the others, so that their jobs can still be tracked.
+
+        Returns
+        -------
+        results : list
+            The return values of submitfunc in the order of dirs
+        """
+        if self.jobname is None and len(dirs):
+            self.jobname = self._autoJobName(dirs[0])
+        if commands is None:
+            commands = [None] * len(dirs)
+
+        def _prepare(d, runscript):
+            logger.info("Queueing %s", d)
+            if runscript is None:
+                runscript = self._getRunScript(d)
+            self._cleanSentinel(d)
+            return submitfunc(d, runscript)
+
+        return _threadMap(
+            _prepare, dirs, commands, maxworkers=_submitFanout(), onresult=onresult
+        )
+
     @abstractmethod
     def inprogress(self):
         """Subclasses need to implement this method"""
         pass
 
-    def wait(self, sentinel=False, sleeptime=5, reporttime=None, reportcallback=None):
+    def wait(
+        self,
+        sentinel=False,
+        sleeptime=5,
+        reporttime=None,
+        reportcallback=None,
+        maxsleeptime=None,
+    ):
         """Blocks script execution until all queued work completes
 
         Parameters
@@ -131,47 +223,73 @@ class SimQueue(ABC, ProtocolInterface):
             The number of seconds to sleep before re-checking for completed jobs.
         reporttime : float
             If set to a number it will report every `reporttime` seconds the number of non-completed jobs.
-            If this argument is larger than `sleepttime`, the method will adjust it to the closest multiple of
-            `sleepttime`. If it is shorter than `sleepttime` it will override the `sleepttime` value.
+            The report is made at the first check after `reporttime` seconds have passed since the last one.
+            If it is shorter than `sleepttime` it will override the `sleepttime` value.
         reportcallback : method
             If not None, the reportcallback method will receive as it's first argument the number of non-completed
             jobs.
+        maxsleeptime : float
+            If set, the sleep time grows by a factor of 1.5 after every check in which no jobs completed, up to
+            `maxsleeptime` seconds. It goes back to `sleeptime` as soon as jobs complete.
 
         Examples
         --------
         >>> self.wait()
         """
-        from time import sleep
-        import sys
+        if reporttime is not None and reporttime < sleeptime:
+            sleeptime = reporttime
 
+        nextreport = None
         if reporttime is not None:
-            if reporttime > sleeptime:
-                from math import round
-
-                reportfrequency = round(reporttime / sleeptime)
-            else:
-                reportfrequency = 1
-                sleeptime = reporttime
-
-        i = 1
-        while True:
-            inprog = self.inprogress() if not sentinel else self.notcompleted()
-            if reporttime is not None:
-                if i == reportfrequency:
+            # The first check happens immediately, so the first report is due one sleep earlier
+            nextreport = time.monotonic() + reporttime - sleeptime
+
+        delay = sleeptime
+        lastinprog = None
+        # With sentinels, inotify can wake the loop up early when a job finishes
+        watcher = None
+        try:
+            while True:
+                inprog = self.inprogress() if not sentinel else self.notcompleted()
+                if nextreport is not None and time.monotonic() >= nextreport:
                     if reportcallback is not None:
                         reportcallback(inprog)
                     else:
-                        logger.info("{} jobs are pending completion".format(inprog))
-                    i = 1
-                else:
-                    i += 1
-            self.retrieve()
+                        logger.info("%d jobs are pending completion", inprog)
+                    nextreport = time.monotonic() + reporttime
+                self.retrieve()
+
+                if inprog == 0:
+                    break
 
-            if inprog == 0:
-                break
+                if maxsleeptime is not None:
+                    if inprog == lastinprog:
+                        delay = min(delay * 1.5, maxsleeptime)
+                    else:
+                        delay = sleeptime
+                    lastinprog = inprog
+
+                if sentinel and watcher is None:
+                    watcher = self._sentinelWatcher()
 
-            sys.stdout.flush()
-            sleep(sleeptime)
+                sys.stdout.flush()
+                if watcher:
+                    watcher.wait(delay)
+                else:
+                    time.sleep(delay)
+        finally:
+            if watcher:
+                watcher.close()
+
+    def _sentinelWatcher(self):
+        # Returns False if the directories can't be watched, in which case wait() just sleeps
+        try:
+            return _SentinelWatcher(list(self._dirs), self._sentinel)
+        except OSError as e:
+            logger.debug(
+                "Polling for sentinel files, since they cannot be watched: %s", e
+            )
+            return False
 
     def notcompleted(self):
         """Returns the sum of the number of job directories which do not have the sentinel file for completion.
@@ -181,30 +299,32 @@ class SimQueue(ABC, ProtocolInterface):
         total : int
             Total number of directories which have not completed
         """
-        import os
-
-        total = 0
         if self._dirs is None:
             raise RuntimeError("This method relies on running synchronously.")
-        for i in self._dirs:
-            if not os.path.exists(os.path.join(i, self._sentinel)):
-                total += 1
-        return total
+        pending = list(self._dirs)
+        sentinels = [os.path.join(i, self._sentinel) for i in pending]
+        if len(pending) > _PARALLEL_STAT_THRESHOLD:
+            # On network filesystems each stat waits for a server round-trip, so overlap them
+            exists = _threadMap(os.path.exists, sentinels)
+        else:
+            exists = map(os.path.exists, sentinels)
+        for i, done in zip(pending, exists):
+            if done:
+                # Completed directories are not checked again unless they are resubmitted
+                del self._dirs[i]
+        return len(self._dirs)
 
     def _cleanSentinel(self, d):
-        import os
-
-        if os.path.exists(os.path.join(d, self._sentinel)):
-            try:
-                os.remove(os.path.join(d, self._sentinel))
-            except Exception:
-                logger.warning(f"Could not remove {self._sentinel} sentinel from {d}")
-            else:
-                logger.debug(f"Removed existing {self._sentinel} sentinel from {d}")
+        try:
+            os.unlink(os.path.join(d, self._sentinel))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning(f"Could not remove {self._sentinel} sentinel from {d}")
+        else:
+            logger.debug("Removed existing %s sentinel from %s", self._sentinel, d)
 
     def _getRunScript(self, d):
-        import os
-
         runscript = os.path.abspath(os.path.join(d, self.runscript))
         if not os.path.exists(runscript):
             raise FileExistsError(f"File {runscript} does not exist.")
@@ -6,14 +6,12 @@
 import os
 import shutil
 import random
-import string
 from jobqueues.config import loadConfig
 import yaml
 from subprocess import check_output, CalledProcessError
 from protocolinterface import val
-from jobqueues.simqueue import SimQueue, QueueJobStatus, _inProgressStatus
-from jobqueues.util import ensurelist
-import getpass
+from jobqueues.simqueue import SimQueue, QueueJobStatus, _inProgressStatus, _currentUser
+from jobqueues.util import ensurelist, _writeScript
 import unittest
 import logging
 
@@ -227,7 +225,7 @@ class SlurmQueue(SimQueue):
             "user",
             "str",
             "The SLURM user submitting and managing jobs",
-            getpass.getuser(),
+            _currentUser(),
             val.String(),
         )
         self._arg(
@@ -400,9 +398,7 @@ class SlurmQueue(SimQueue):
             run_as_daemon=len(runsh) > 1,
             nvidia_mps=nvidia_mps,
         )
-        with open(fname, "w") as f:
-            f.write(job_str)
-        os.chmod(fname, 0o700)
+        _writeScript(fname, job_str)
 
     def retrieve(self):
         # Nothing to do
@@ -412,8 +408,7 @@ class SlurmQueue(SimQueue):
         path = ensurelist(path)
         return (
             "_".join([os.path.basename(os.path.abspath(x)) for x in path])
-            + "_"
-            + "".join([random.choice(string.digits) for _ in range(5)])
+            + f"_{random.randrange(100000):05d}"
         )
 
     def submit(self, dirs, commands=None, _dryrun=False, nvidia_mps=False):
@@ -448,7 +443,8 @@ class SlurmQueue(SimQueue):
                     logger.info(f"Dry run. Here it would call submit on {jobscript}")
                 else:
                     ret = check_output([self._qsubmit, jobscript])
-                    logger.debug(ret.decode("ascii"))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(ret.decode("ascii"))
             except CalledProcessError as e:
                 logger.error(e.output)
                 raise
@@ -458,7 +454,7 @@ class SlurmQueue(SimQueue):
 
         # if all folders exist, submit
         for i, d in enumerate(dirs):
-            logger.info("Queueing " + d)
+            logger.info("Queueing %s", d)
 
             if self.jobname is None:
                 self.jobname = self._autoJobName(d)
@@ -473,7 +469,8 @@ class SlurmQueue(SimQueue):
                     logger.info(f"Dry run. Here it would call submit on {jobscript}")
                 else:
                     ret = check_output([self._qsubmit, jobscript])
-                    logger.debug(ret.decode("ascii"))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(ret.decode("ascii"))
             except CalledProcessError as e:
                 logger.error(e.output)
                 raise
@@ -555,12 +552,14 @@ class SlurmQueue(SimQueue):
                 cmd = [self._qcancel, "-n", self.jobname, "-u", self.user, "-p", q]
                 logger.debug(cmd)
                 ret = check_output(cmd)
-                logger.debug(ret.decode("ascii"))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(ret.decode("ascii"))
         else:
             cmd = [self._qcancel, "-n", self.jobname, "-u", self.user]
             logger.debug(cmd)
             ret = check_output(cmd)
-            logger.debug(ret.decode("ascii"))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(ret.decode("ascii"))
 
     def jobInfo(self):
         if self.jobname is None:
@@ -616,7 +615,7 @@ class SlurmQueue(SimQueue):
 
     @ncpu.setter
     def ncpu(self, value):
-        self.ncpu = value
+        self.__dict__["ncpu"] = value
 
     @property
     def ngpu(self):
@@ -624,7 +623,7 @@ class SlurmQueue(SimQueue):
 
     @ngpu.setter
     def ngpu(self, value):
-        self.ngpu = value
+        self.__dict__["ngpu"] = value
 
     @property
     def memory(self):
@@ -632,4 +631,4 @@ class SlurmQueue(SimQueue):
 
     @memory.setter
     def memory(self, value):
-        self.memory = value
+        self.__dict__["memory"] = value
@@ -1,4 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
+import os
+import ctypes
+import select
+import struct
+import threading
+import time
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +31,191 @@ def ensurelist(tocheck, tomod=None):
     return tomod
 
 
+@functools.lru_cache(maxsize=None)
+def _splitPath(path):
+    return tuple(path.split(os.pathsep))
+
+
+def _isExecutable(fname):
+    return os.path.isfile(fname) and os.access(fname, os.X_OK)
+
+
+# Resolved executable paths shared by all queue instances, see invalidate_binary_cache
+_BIN_CACHE = {}
+
+
+def invalidate_binary_cache():
+    """Forgets the executable paths resolved so far, so that they are looked up again in PATH"""
+    _BIN_CACHE.clear()
+
+
+def _find_binary(binary):
+    # Cached since the queue classes look up the same executables on every instantiation
+    ret = _BIN_CACHE.get(binary)
+    if ret is None:
+        ret = _BIN_CACHE[binary] = _resolve_binary(binary)
+    return ret
+
+
+def _resolve_binary(binary):
+    if os.path.dirname(binary):
+        candidates = [binary]
+    else:
+        candidates = (
+            os.path.join(d, binary)
+            for d in _splitPath(os.environ.get("PATH", os.defpath))
+        )
+    for ret in candidates:
+        if _isExecutable(ret):
+            return os.path.abspath(ret)
+    raise FileNotFoundError("Could not find required executable [{}]".format(binary))
+
+
+# Marks the _threadMap calls which were not started because an earlier one failed
+_SKIPPED = object()
+
+
+def _threadMap(func, *iterables, maxworkers=32, onresult=None):
+    """Applies func over the iterables in a thread pool and returns the results in order
+
+    Used to overlap the scheduler round-trips of the per-directory job submissions. If a call
+    raises, the calls which have not started yet are cancelled and the first error is raised
+    once the running ones have finished. If onresult is given it is called in order with the
+    result of every call which succeeded, including when an error is raised afterwards.
+    """
+    args = list(zip(*iterables))
+    if len(args) == 0:
+        return []
+
+    failed = threading.Event()
+
+    def _call(a):
+        # Calls queued behind a failed one are skipped instead of started
+        if failed.is_set():
+            return _SKIPPED
+        try:
+            return func(*a)
+        except BaseException:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=min(maxworkers, len(args))) as ex:
+        futures = [ex.submit(_call, a) for a in args]
+
+    results = []
+    error = None
+    for f in futures:
+        if f.exception() is not None:
+            if error is None:
+                error = f.exception()
+            continue
+        if f.result() is _SKIPPED:
+            continue
+        results.append(f.result())
+        if onresult is not None:
+            onresult(f.result())
+    if error is not None:
+        raise error
+    return results
+
+
+def _writeScript(fname, content):
+    """Writes an executable script with mode 0o700, set on the open file instead of a separate chmod"""
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o700)
+    # The mode of os.open only applies when the file is created, and is masked by the umask
+    os.fchmod(fd, 0o700)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+
+
+# inotify constants from <sys/inotify.h>
+_IN_CREATE = 0x00000100
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class _SentinelWatcher:
+    """Waits for sentinel files to be created in a set of directories using Linux inotify
+
+    Raises OSError if inotify is not available or the directories cannot be watched, in which case
+    the caller should fall back to polling. Note that inotify only reports files created through the
+    local kernel, so sentinels written by other hosts on network filesystems are not seen.
+    """
+
+    def __init__(self, dirs, sentinel):
+        self._sentinel = os.fsencode(sentinel)
+        self._fd = None
+        self._epoll = None
+        if not hasattr(select, "epoll"):
+            raise OSError("epoll is not available")
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+            self._addwatch = libc.inotify_add_watch
+        except (OSError, AttributeError, TypeError):
+            raise OSError("inotify is not available")
+        self._addwatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self._fd = init(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            self._fd = None
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = _IN_CREATE | _IN_MOVED_TO
+        try:
+            for d in dirs:
+                if self._addwatch(self._fd, os.fsencode(d), mask) < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, f"Could not watch {d}: {os.strerror(err)}")
+            self._epoll = select.epoll()
+            self._epoll.register(self._fd, select.EPOLLIN)
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        """Blocks for up to timeout seconds and returns True as soon as a sentinel file is created"""
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0 or not self._epoll.poll(remaining):
+                return False
+            if self._drain():
+                return True
+
+    def _drain(self):
+        # Reads all queued events and checks if any of them created a sentinel file
+        found = False
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return found
+            pos = 0
+            while pos < len(buf):
+                _, _, _, namelen = _INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += _INOTIFY_EVENT.size
+                name = buf[pos : pos + namelen].rstrip(b"\0")
+                pos += namelen
+                if name == self._sentinel:
+                    found = True
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def _getCPUdevices():
     import psutil
 
@@ -34,9 +227,9 @@ def _getGPUdevices():
 
     logger.info("Trying to determine all GPU devices")
     try:
-        check_output("nvidia-smi -L", shell=True)
-        ngpu = check_output("nvidia-smi -L | wc -l", shell=True).decode("ascii")
-        devices = range(int(ngpu))
+        # nvidia-smi lists one GPU per line
+        ret = check_output(["nvidia-smi", "-L"], text=True)
+        devices = range(len(ret.splitlines()))
     except Exception:
         raise
     return devices
@@ -0,0 +1,65 @@
+from jobqueues.config import _parseYaml
+import jobqueues.config
+import json
+import os
+
+
+def _write_yaml(tmpdir, content):
+    path = str(tmpdir.join("config.yml"))
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def _test_yaml_sidecar(tmpdir):
+    path = _write_yaml(tmpdir, "app:\n  ncpu: 4\n")
+    sidecar = path + ".cache.json"
+
+    assert _parseYaml(path) == {"app": {"ncpu": 4}}
+    assert os.path.exists(sidecar)
+
+    # A sidecar with the current content version is used instead of parsing the YAML
+    with open(sidecar, "r") as f:
+        cached = json.load(f)
+    cached["configuration"] = {"app": {"ncpu": 8}}
+    with open(sidecar, "w") as f:
+        json.dump(cached, f)
+    assert _parseYaml(path) == {"app": {"ncpu": 8}}
+
+
+def _test_yaml_sidecar_stale(tmpdir):
+    path = _write_yaml(tmpdir, "app:\n  ncpu: 4\n")
+    sidecar = path + ".cache.json"
+    _parseYaml(path)
+    with open(sidecar, "r") as f:
+        version = json.load(f)["content-version"]
+
+    _write_yaml(tmpdir, "app:\n  ncpu: 2\n")
+    assert _parseYaml(path) == {"app": {"ncpu": 2}}
+    with open(sidecar, "r") as f:
+        cached = json.load(f)
+    assert cached["content-version"] != version
+    assert cached["configuration"] == {"app": {"ncpu": 2}}
+
+
+def _test_yaml_sidecar_unwritable(tmpdir, monkeypatch):
+    def mkstemp(*args, **kwargs):
+        raise PermissionError("read-only directory")
+
+    monkeypatch.setattr(jobqueues.config.tempfile, "mkstemp", mkstemp)
+    path = _write_yaml(tmpdir, "app:\n  ncpu: 4\n")
+
+    assert _parseYaml(path) == {"app": {"ncpu": 4}}
+    assert not os.path.exists(path + ".cache.json")
+    assert os.listdir(str(tmpdir)) == ["config.yml"]
+
+
+def _test_yaml_sidecar_mode(tmpdir):
+    umask = os.umask(0o022)
+    try:
+        path = _write_yaml(tmpdir, "app:\n  ncpu: 4\n")
+        _parseYaml(path)
+    finally:
+        os.umask(umask)
+
+    assert os.stat(path + ".cache.json").st_mode & 0o777 == 0o644
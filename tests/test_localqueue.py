@@ -0,0 +1,162 @@
+from jobqueues.localqueue import LocalCPUQueue
+import time
+import os
+
+
+def _create_execdir(tmpdir, runsh):
+    os.makedirs(tmpdir)
+    run_sh = os.path.join(tmpdir, "run.sh")
+    with open(run_sh, "w") as f:
+        f.write(runsh)
+    os.chmod(run_sh, 0o700)
+    return tmpdir
+
+
+def _test_submit_runscript(tmpdir):
+    execdirs = [
+        _create_execdir(str(tmpdir.join("0")), "#!/bin/bash\ntouch out.xtc\n"),
+        # Scripts without a shebang are executed with bash
+        _create_execdir(str(tmpdir.join("1")), "touch out.xtc\n"),
+    ]
+    datadir = str(tmpdir.join("data"))
+
+    lo = LocalCPUQueue()
+    lo.maxcpu = 1
+    lo.datadir = datadir
+    lo.submit(execdirs)
+    lo.wait(sentinel=True, sleeptime=0.1)
+    lo.stop()
+
+    for ed in execdirs:
+        assert os.path.exists(os.path.join(ed, "jobqueues.done"))
+        assert not os.path.exists(os.path.join(ed, "out.xtc"))
+        assert os.path.exists(os.path.join(datadir, os.path.basename(ed), "out.xtc"))
+
+
+def _test_submit_command(tmpdir):
+    execdir = str(tmpdir.join("0"))
+    os.makedirs(execdir)
+
+    lo = LocalCPUQueue()
+    lo.maxcpu = 1
+    lo.submit([execdir], commands=["echo $PWD > pwd.txt; exit 1"])
+    lo.wait(sentinel=True, sleeptime=0.1)
+    lo.stop()
+
+    # The sentinel is created also when the job fails
+    assert os.path.exists(os.path.join(execdir, "jobqueues.done"))
+    with open(os.path.join(execdir, "pwd.txt"), "r") as f:
+        assert f.read().strip() == execdir
+    assert lo.inprogress() == 0
+
+
+def _test_resubmit_relative(tmpdir, monkeypatch):
+    execdir = str(tmpdir.join("0"))
+    os.makedirs(execdir)
+    monkeypatch.chdir(str(tmpdir))
+
+    lo = LocalCPUQueue()
+    lo.maxcpu = 1
+    lo.submit(["0"], commands=["touch first.txt"])
+    lo.wait(sentinel=True, sleeptime=0.1)
+    assert lo.notcompleted() == 0
+
+    # A completed directory which is submitted again is waited for again
+    lo.submit(["0"], commands=["sleep 0.5; touch second.txt"])
+    assert lo.notcompleted() == 1
+    # The same directory passed by absolute path is tracked once
+    lo._submitinit([execdir])
+    assert lo.notcompleted() == 1
+    lo.wait(sentinel=True, sleeptime=0.1)
+    lo.stop()
+
+    assert os.path.exists(os.path.join(execdir, "second.txt"))
+
+
+def _test_unknown_user(monkeypatch):
+    import pwd
+    from jobqueues.simqueue import _currentUser
+
+    def getpwuid(uid):
+        raise KeyError(f"getpwuid(): uid not found: {uid}")
+
+    monkeypatch.setattr(pwd, "getpwuid", getpwuid)
+    for var in ("LOGNAME", "USER", "LNAME", "USERNAME"):
+        monkeypatch.delenv(var, raising=False)
+    _currentUser.cache_clear()
+    try:
+        # Local queues do not need the user name
+        lo = LocalCPUQueue()
+        lo.stop()
+        assert _currentUser() == str(os.geteuid())
+    finally:
+        _currentUser.cache_clear()
+
+
+def _test_wait_unwatchable(tmpdir):
+    import threading
+
+    # Directories which cannot be watched are polled
+    execdir = str(tmpdir.join("missing"))
+
+    def complete():
+        time.sleep(0.3)
+        os.makedirs(execdir)
+        open(os.path.join(execdir, "jobqueues.done"), "w").close()
+
+    lo = LocalCPUQueue()
+    lo._submitinit([execdir])
+    assert lo._sentinelWatcher() is False
+
+    t = threading.Thread(target=complete)
+    t.start()
+    lo.wait(sentinel=True, sleeptime=0.1)
+    t.join()
+    lo.stop()
+    assert lo.notcompleted() == 0
+
+
+def _test_wait_report(tmpdir):
+    execdir = str(tmpdir.join("0"))
+    os.makedirs(execdir)
+
+    lo = LocalCPUQueue()
+    lo.maxcpu = 1
+    lo.submit([execdir], commands=["sleep 0.5"])
+    reports = []
+    lo.wait(
+        sentinel=True, sleeptime=0.05, reporttime=0.2, reportcallback=reports.append
+    )
+    lo.stop()
+
+    assert os.path.exists(os.path.join(execdir, "jobqueues.done"))
+    assert len(reports) > 0
+    assert reports[0] == 1
+
+
+def _test_wait_backoff(tmpdir, monkeypatch):
+    import threading
+
+    execdir = str(tmpdir.join("0"))
+    os.makedirs(execdir)
+
+    # Record the sleeps of the waiting thread only, not the ones of the queue workers
+    delays = []
+    sleep = time.sleep
+
+    def recordsleep(seconds):
+        if threading.current_thread() is threading.main_thread():
+            delays.append(seconds)
+        sleep(seconds)
+
+    lo = LocalCPUQueue()
+    lo.maxcpu = 1
+    lo.submit([execdir], commands=["sleep 1"])
+    monkeypatch.setattr(time, "sleep", recordsleep)
+    lo.wait(sleeptime=0.05, maxsleeptime=0.2)
+    monkeypatch.undo()
+    lo.stop()
+
+    assert lo.inprogress() == 0
+    assert delays[:2] == [0.05, 0.05 * 1.5]
+    assert max(delays) == 0.2
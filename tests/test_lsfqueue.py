@@ -0,0 +1,126 @@
+from pytest import fixture
+from distutils import dir_util
+from jobqueues.lsfqueue import LsfQueue
+import jobqueues.lsfqueue
+import json
+import os
+
+
+@fixture
+def datadir(tmpdir, request):
+    """
+    Fixture responsible for searching a folder with the same name of test
+    module and, if available, moving all contents to a temporary directory so
+    tests can use them freely.
+    """
+    filename = request.module.__file__
+    test_dir, _ = os.path.splitext(filename)
+
+    if os.path.isdir(test_dir):
+        dir_util.copy_tree(test_dir, str(tmpdir))
+
+    return tmpdir
+
+
+def _test_job_script(datadir):
+    execdir = str(datadir.join("0"))
+    os.makedirs(execdir)
+
+    lq = LsfQueue(_findExecutables=False)
+    lq.jobname = "test"
+    lq.queue = ["q1", "q2"]
+    lq.ngpu = 1
+    lq.version = 10
+    lq.prerun = ["module load cuda"]
+    lq.datadir = str(datadir.join("data"))
+
+    jobsh = os.path.join(execdir, "job.sh")
+    lq._createJobScript(jobsh, execdir, os.path.join(execdir, "run.sh"))
+
+    with open(datadir.join("_job_script.sh"), "r") as f:
+        expected = f.read().strip()
+    with open(jobsh, "r") as f:
+        jobsh = f.read().replace(str(datadir), "TESTDIR_PLACEHOLDER").strip()
+
+    assert jobsh == expected
+    assert os.access(os.path.join(execdir, "job.sh"), os.X_OK)
+
+
+def _test_job_script_existing(tmpdir):
+    execdir = str(tmpdir)
+    jobsh = os.path.join(execdir, "job.sh")
+    with open(jobsh, "w") as f:
+        f.write("old")
+    os.chmod(jobsh, 0o644)
+
+    lq = LsfQueue(_findExecutables=False)
+    lq.jobname = "test"
+    lq.queue = "q1"
+    lq._createJobScript(jobsh, execdir, os.path.join(execdir, "run.sh"))
+
+    assert os.stat(jobsh).st_mode & 0o777 == 0o700
+
+
+def _test_submit_pack(tmpdir, monkeypatch):
+    monkeypatch.setenv("LSB_MAX_PACK_JOBS", "2")
+    packs = []
+
+    def check_output(cmd, **kwargs):
+        assert cmd[1] == "-pack"
+        with open(cmd[2], "r") as f:
+            lines = f.read().splitlines()
+        packs.append(lines)
+        first = 100 * len(packs)
+        return "".join(
+            f"Job <{first + i}> is submitted to queue <q1>.\n"
+            for i in range(len(lines))
+        )
+
+    monkeypatch.setattr(jobqueues.lsfqueue, "check_output", check_output)
+
+    dirs = []
+    for i in range(3):
+        dirs.append(str(tmpdir.join(str(i))))
+        os.makedirs(dirs[-1])
+
+    lq = LsfQueue(_findExecutables=False)
+    lq._qsubmit = "bsub"
+    lq.jobname = "test"
+    lq.queue = ["q1", "q2"]
+    lq.submit(dirs, commands=["run.sh"] * 3)
+
+    # One bsub -pack call per LSB_MAX_PACK_JOBS jobs
+    assert [len(p) for p in packs] == [2, 1]
+    lines = packs[0] + packs[1]
+    for d, line in zip(dirs, lines):
+        jobscript = os.path.join(d, "job.sh")
+        assert line == " ".join(lq._bsubOptions(d) + [jobscript])
+        assert os.access(jobscript, os.X_OK)
+    assert lq._joblist == ["100", "101", "200"]
+
+
+def _test_inprogress_json(monkeypatch):
+    calls = []
+    records = [
+        {"STAT": "RUN", "QUEUE": "q1"},
+        {"STAT": "PEND", "QUEUE": "q2"},
+        {"STAT": "PEND", "QUEUE": "q2"},
+        {"STAT": "PEND", "QUEUE": "other"},
+    ]
+
+    def check_output(cmd, **kwargs):
+        calls.append(cmd)
+        return json.dumps({"COMMAND": "bjobs", "JOBS": 4, "RECORDS": records})
+
+    monkeypatch.setattr(jobqueues.lsfqueue, "check_output", check_output)
+
+    lq = LsfQueue(_findExecutables=False)
+    lq._qstatus = "bjobs"
+    lq.version = 10
+    lq.jobname = "test"
+    lq.queue = ["q1", "q2"]
+
+    # A single query for all queues, counting the jobs of the queue's own queues
+    assert lq.inprogress() == 3
+    assert len(calls) == 1
+    assert calls[0][-3:] == ["-o", "stat queue", "-json"]
@@ -0,0 +1,20 @@
+#!/bin/bash
+#
+#BSUB -J test
+#BSUB -q "q1 q2"
+#BSUB -n 1
+#BSUB -gpu "num=1:mode=exclusive_process"
+#BSUB -M 4000000
+#BSUB -cwd TESTDIR_PLACEHOLDER/0
+#BSUB -outdir TESTDIR_PLACEHOLDER/0
+#BSUB -o lsf.%J.out
+#BSUB -e lsf.%J.err
+#BSUB --env ACEMD_HOME
+
+trap "touch TESTDIR_PLACEHOLDER/0/jobqueues.done" EXIT SIGTERM
+
+module load cuda
+
+cd TESTDIR_PLACEHOLDER/0
+TESTDIR_PLACEHOLDER/0/run.sh
+mv *.xtc TESTDIR_PLACEHOLDER/data/0
@@ -0,0 +1,66 @@
+from subprocess import CalledProcessError
+from jobqueues.pbsqueue import PBSQueue
+import jobqueues.pbsqueue
+import threading
+import pytest
+import os
+
+
+def _setup_dirs(tmpdir, n):
+    dirs = []
+    for i in range(n):
+        d = str(tmpdir.join(str(i)))
+        os.makedirs(d)
+        runsh = os.path.join(d, "run.sh")
+        with open(runsh, "w") as f:
+            f.write("#!/bin/bash\n")
+        os.chmod(runsh, 0o700)
+        dirs.append(d)
+    return dirs
+
+
+def _mock_qsub(monkeypatch, faildir, barrier=None):
+    calls = []
+    lock = threading.Lock()
+
+    def check_output(cmd, **kwargs):
+        with lock:
+            calls.append(cmd[1])
+        if barrier is not None:
+            barrier.wait(timeout=10)
+        if os.path.dirname(cmd[1]) == faildir:
+            raise CalledProcessError(1, cmd, output="qsub: failed")
+        return f"{os.path.basename(os.path.dirname(cmd[1]))}.pbs\n"
+
+    monkeypatch.setattr(jobqueues.pbsqueue, "check_output", check_output)
+    return calls
+
+
+def _test_submit_failure_keeps_jobids(tmpdir, monkeypatch):
+    dirs = _setup_dirs(tmpdir, 4)
+    # All submissions are in flight before the failing one returns
+    calls = _mock_qsub(monkeypatch, dirs[2], threading.Barrier(4))
+
+    pq = PBSQueue(_findExecutables=False)
+    pq._qsubmit = "qsub"
+    pq.queue = "default"
+    with pytest.raises(CalledProcessError):
+        pq.submit(dirs)
+
+    assert len(calls) == 4
+    assert sorted(pq._joblist) == ["0.pbs", "1.pbs", "3.pbs"]
+
+
+def _test_submit_failure_cancels_pending(tmpdir, monkeypatch):
+    monkeypatch.setenv("JOBQUEUES_SUBMIT_FANOUT", "1")
+    dirs = _setup_dirs(tmpdir, 4)
+    calls = _mock_qsub(monkeypatch, dirs[2])
+
+    pq = PBSQueue(_findExecutables=False)
+    pq._qsubmit = "qsub"
+    pq.queue = "default"
+    with pytest.raises(CalledProcessError):
+        pq.submit(dirs)
+
+    assert len(calls) == 3
+    assert pq._joblist == ["0.pbs", "1.pbs"]
@@ -0,0 +1,88 @@
+from pytest import fixture
+from distutils import dir_util
+from jobqueues.sgequeue import SgeQueue, _taskCount
+import xml.etree.ElementTree as ET
+import jobqueues.sgequeue
+import os
+
+
+@fixture
+def datadir(tmpdir, request):
+    """
+    Fixture responsible for searching a folder with the same name of test
+    module and, if available, moving all contents to a temporary directory so
+    tests can use them freely.
+    """
+    filename = request.module.__file__
+    test_dir, _ = os.path.splitext(filename)
+
+    if os.path.isdir(test_dir):
+        dir_util.copy_tree(test_dir, str(tmpdir))
+
+    return tmpdir
+
+
+def _test_task_count():
+    def job(tasks):
+        if tasks is None:
+            return ET.fromstring("<job_list><JB_name>PMtest</JB_name></job_list>")
+        return ET.fromstring(f"<job_list><tasks>{tasks}</tasks></job_list>")
+
+    assert _taskCount(job(None)) == 1
+    assert _taskCount(job("3")) == 1
+    assert _taskCount(job("2-10:1")) == 9
+    assert _taskCount(job("1-10:3")) == 4
+    assert _taskCount(job("1,4-6:1")) == 4
+
+
+def _test_array_script(datadir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        jobqueues.sgequeue, "check_output", lambda cmd, **kwargs: calls.append(cmd)
+    )
+
+    dirs = []
+    for i in range(2):
+        dirs.append(str(datadir.join(str(i))))
+        os.makedirs(dirs[-1])
+
+    sq = SgeQueue(_findExecutables=False)
+    sq._qsubmit = "qsub"
+    sq.jobname = "test"
+    sq.queue = "q1"
+    sq.submit(dirs, commands=["run.sh", "run.sh"], batch=True)
+
+    arrayscript = os.path.join(dirs[0], "array_job.sh")
+    assert calls == [["qsub", "-t", "1-2", arrayscript]]
+
+    with open(datadir.join("_array_job.sh"), "r") as f:
+        expected = f.read().strip()
+    with open(arrayscript, "r") as f:
+        arraysh = f.read().replace(str(datadir), "TESTDIR_PLACEHOLDER").strip()
+
+    assert arraysh == expected
+    for d in dirs:
+        assert os.access(os.path.join(d, "job.sh"), os.X_OK)
+
+
+def _test_stop(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        jobqueues.sgequeue, "check_output", lambda cmd, **kwargs: calls.append(cmd)
+    )
+    jobs = [("1", "PMtest"), ("2", "PMtest"), ("1", "PMtest"), ("3", "PMother")]
+    xml = "<job_info><queue_info>{}</queue_info></job_info>".format(
+        "".join(
+            f"<job_list><JB_job_number>{i}</JB_job_number><JB_name>{n}</JB_name></job_list>"
+            for i, n in jobs
+        )
+    )
+
+    sq = SgeQueue(_findExecutables=False)
+    sq._qcancel = "qdel"
+    sq.jobname = "test"
+    monkeypatch.setattr(sq, "_getJobStatusTree", lambda: ET.fromstring(xml))
+    sq.stop()
+
+    # Array tasks of the same job are cancelled once
+    assert calls == [["qdel", "1", "2"]]
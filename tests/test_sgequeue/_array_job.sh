@@ -0,0 +1,20 @@
+#!/bin/bash
+#
+#$ -N PMtest
+#$ -q "q1"
+#$ -wd TESTDIR_PLACEHOLDER/0
+#$ -pe thread 1
+#$ -l ngpus=1
+#$ -v ACEMD_HOME,HTMD_LICENSE_FILE
+
+JOBSCRIPTS=(
+"TESTDIR_PLACEHOLDER/0/job.sh"
+"TESTDIR_PLACEHOLDER/1/job.sh"
+)
+
+JOBSCRIPT="${JOBSCRIPTS[$((SGE_TASK_ID - 1))]}"
+JOBDIR="$(dirname "$JOBSCRIPT")"
+
+# The tasks run in the first directory, so keep their output in their own directories
+# under the names SGE gives to the output of single jobs
+exec "$JOBSCRIPT" > "$JOBDIR/PMtest.o$JOB_ID" 2> "$JOBDIR/PMtest.e$JOB_ID"
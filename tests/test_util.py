@@ -0,0 +1,40 @@
+from jobqueues.util import _SentinelWatcher
+import threading
+import pytest
+import time
+import os
+
+
+def _touch_later(path, delay=0.2):
+    def touch():
+        time.sleep(delay)
+        open(path, "w").close()
+
+    t = threading.Thread(target=touch)
+    t.start()
+    return t
+
+
+def _test_sentinel_watcher_created(tmpdir):
+    dirs = [str(tmpdir.mkdir("0")), str(tmpdir.mkdir("1"))]
+    with _SentinelWatcher(dirs, "jobqueues.done") as watcher:
+        t = _touch_later(os.path.join(dirs[1], "jobqueues.done"))
+        start = time.monotonic()
+        assert watcher.wait(10)
+        assert time.monotonic() - start < 5
+        t.join()
+
+
+def _test_sentinel_watcher_other_files(tmpdir):
+    d = str(tmpdir)
+    with _SentinelWatcher([d], "jobqueues.done") as watcher:
+        t = _touch_later(os.path.join(d, "output.xtc"), delay=0)
+        start = time.monotonic()
+        assert not watcher.wait(0.5)
+        assert time.monotonic() - start >= 0.5
+        t.join()
+
+
+def _test_sentinel_watcher_missing_dir(tmpdir):
+    with pytest.raises(OSError):
+        _SentinelWatcher([str(tmpdir.join("missing"))], "jobqueues.done")